@@ -14,14 +14,30 @@
 
 from __future__ import absolute_import
 
+import base64
+import calendar
+import collections
+import hashlib
 import json
+import os
+import random
+import re
 import requests
 import saml2
 import saml2.client
 import saml2.config
+import saml2.metadata
+import saml2.s_utils
+import saml2.sigver
+import saml2.time_util
 import six
+import time
 import uuid
 
+from defusedxml import ElementTree
+from six.moves import http_client
+from six.moves.urllib import parse as urlparse
+
 from st2auth.sso import base as st2auth_sso
 from st2common import log as logging
 from st2common.exceptions import auth as auth_exc
@@ -33,25 +49,166 @@ __all__ = [
 
 LOG = logging.getLogger(__name__)
 
+SP_METADATA_NSPAIR = {'xs': 'http://www.w3.org/2001/XMLSchema'}
+
+# Elements in a SAMLResponse which carry user data or key material and are blanked out
+# before a response is kept for diagnostics. An element without a closing tag, as in a
+# truncated document, is blanked out through to the end of the payload.
+REDACTED_SAML_ELEMENTS_REGEX = re.compile(
+    r'(<(?:[\w.-]+:)?(AttributeValue|NameID|SignatureValue|DigestValue|X509Certificate|'
+    r'CipherValue)\b[^>]*>)(.*?)(</(?:[\w.-]+:)?\2\s*>|\Z)',
+    re.DOTALL
+)
+
+# Attributes which carry session or user data, such as the session index used for logout or
+# the client address, are blanked out as well. A value cut off by truncation is blanked
+# through to the end of the payload.
+REDACTED_SAML_ATTRIBUTES_REGEX = re.compile(
+    r'(\s(?:SessionIndex|Address|NameQualifier|SPNameQualifier))\s*=\s*(?:"[^"]*"?|\'[^\']*\'?)'
+)
+
+XML_DECLARATION_ENCODING_REGEX = re.compile(
+    br'^\s*<\?xml[^>]*encoding\s*=\s*["\']([A-Za-z0-9._-]+)["\']'
+)
+
+UTF8_BOM = b'\xef\xbb\xbf'
+
+REDACTED_VALUE = '***'
+
+SAML_METADATA_NS = 'urn:oasis:names:tc:SAML:2.0:metadata'
+XMLDSIG_NS = 'http://www.w3.org/2000/09/xmldsig#'
+
+CALLBACK_LATENCY_PERCENTILES = [50, 90, 99]
+
+AUTHN_REQUEST_ID_REGEX = re.compile(r' ID="[^"]*"')
+AUTHN_REQUEST_ISSUE_INSTANT_REGEX = re.compile(r' IssueInstant="[^"]*"')
+
+
+class SAMLResponseCapture(object):
+    """
+    Fixed size ring buffer of redacted and truncated SAMLResponse payloads kept for diagnostics.
+
+    Failed responses are always captured. Successful responses are captured only when sampled.
+    """
+
+    def __init__(self, size=10, sample_rate=0.0, max_payload_size=8192):
+        self.sample_rate = sample_rate
+        self.max_payload_size = max_payload_size
+        self._records = collections.deque(maxlen=size)
+
+    @staticmethod
+    def _decode_xml(data):
+        if data.startswith(UTF8_BOM):
+            data = data[len(UTF8_BOM):]
+
+        match = XML_DECLARATION_ENCODING_REGEX.match(data)
+        encoding = match.group(1).decode('ascii') if match else 'utf-8'
+
+        try:
+            text = data.decode(encoding).lstrip(u'\ufeff')
+        except (LookupError, UnicodeDecodeError):
+            return None
+
+        return text if text.lstrip().startswith('<') else None
+
+    @classmethod
+    def _redact(cls, payload):
+        """
+        Return the payload as XML with user data and key material blanked out, or None if
+        the payload is not an XML document which can be redacted.
+        """
+        try:
+            xml = cls._decode_xml(base64.b64decode(payload))
+        except Exception:
+            xml = None
+
+        if xml is None:
+            xml = cls._decode_xml(payload)
+
+        if xml is None:
+            return None
+
+        xml = REDACTED_SAML_ELEMENTS_REGEX.sub(r'\1%s\4' % REDACTED_VALUE, xml)
+
+        return REDACTED_SAML_ATTRIBUTES_REGEX.sub(r'\1="%s"' % REDACTED_VALUE, xml)
+
+    def _add(self, outcome, payload, error=None):
+        if payload is None:
+            payload = b''
+
+        if isinstance(payload, six.text_type):
+            payload = payload.encode('utf-8')
+        elif not isinstance(payload, six.binary_type):
+            payload = six.text_type(payload).encode('utf-8')
+
+        # Only a redacted XML document is kept. Anything else is recorded by its length and
+        # hash so the raw payload, which may carry user data, is never stored.
+        redacted = self._redact(payload)
+        truncated = redacted is not None and len(redacted) > self.max_payload_size
+
+        self._records.append({
+            'timestamp': time.time(),
+            'outcome': outcome,
+            'error': error,
+            'payload': redacted[:self.max_payload_size] if redacted is not None else None,
+            'payload_length': len(payload),
+            'payload_sha256': hashlib.sha256(payload).hexdigest(),
+            'truncated': truncated
+        })
+
+    def capture_failure(self, payload, error=None):
+        if self._records.maxlen:
+            self._add('failure', payload, error=error)
+
+    def capture_success(self, payload):
+        if self.sample_rate and self._records.maxlen and random.random() < self.sample_rate:
+            self._add('success', payload)
+
+    def dump(self):
+        """
+        Return the captured responses, oldest first.
+
+        :rtype: ``list`` of ``dict``
+        """
+        return list(self._records)
+
+    def clear(self):
+        self._records.clear()
+
 
 class SAML2SingleSignOnBackend(st2auth_sso.BaseSingleSignOnBackend):
     """
     SAML2 SSO authentication backend.
     """
 
-    def __init__(self, entity_id, metadata_url, debug=False):
+    def __init__(self, entity_id, metadata_url, debug=False, key_file=None, cert_file=None,
+                 sign_metadata=False, capture_size=10, capture_sample_rate=0.0,
+                 capture_max_payload_size=8192, metadata_max_age=None,
+                 latency_window_size=1000):
+        if sign_metadata and not (key_file and cert_file):
+            raise ValueError('The key_file and cert_file are required to sign the SP metadata.')
+
         self.entity_id = entity_id
         self.relay_state_id = uuid.uuid4().hex
         self.https_acs_url = '%s/auth/sso/callback' % self.entity_id
         self.saml_metadata_url = metadata_url
+
+        metadata_fetch_start = time.time()
         self.saml_metadata = requests.get(self.saml_metadata_url)
+        self.saml_metadata_fetched_at = time.time()
+        self.saml_metadata_fetch_duration = self.saml_metadata_fetched_at - metadata_fetch_start
+        self.saml_metadata_status_code = self.saml_metadata.status_code
+        self.saml_metadata_ok = self.saml_metadata.ok
+
+        # Response.text decodes the body on every access so only read it once.
+        saml_metadata_text = self.saml_metadata.text
 
-        LOG.debug('METADATA GET FROM "%s": %s' % (self.saml_metadata_url, self.saml_metadata.text))
+        LOG.debug('METADATA GET FROM "%s": %s', self.saml_metadata_url, saml_metadata_text)
 
         self.saml_client_settings = {
             'entityid': self.entity_id,
             'metadata': {
-                'inline': [self.saml_metadata.text]
+                'inline': [saml_metadata_text]
             },
             'service': {
                 'sp': {
@@ -74,22 +231,250 @@ class SAML2SingleSignOnBackend(st2auth_sso.BaseSingleSignOnBackend):
             }
         }
 
+        if key_file:
+            self.saml_client_settings['key_file'] = key_file
+
+        if cert_file:
+            self.saml_client_settings['cert_file'] = cert_file
+
         if debug:
             self.saml_client_settings['debug'] = 1
 
+        self.sign_metadata = sign_metadata
+
+        # The serialized SP metadata is cached along with its ETag and the fingerprint of the
+        # configuration and keys it was generated from. See get_sp_metadata.
+        self._sp_metadata_cache = None
+        self._sp_metadata_config_hash = self._get_sp_metadata_config_hash()
+
+        # The AuthnRequest skeleton and IdP destination are constant for a given IdP metadata.
+        # They are cached along with the settings they were built from. See
+        # _get_authn_request_template.
+        self._authn_request_template = None
+
+        self.response_capture = SAMLResponseCapture(
+            size=capture_size,
+            sample_rate=capture_sample_rate,
+            max_payload_size=capture_max_payload_size
+        )
+
+        # Everything reported by get_health is either computed here or updated in place on
+        # the request path so the health check itself doesn't do network calls or crypto.
+        self.metadata_max_age = metadata_max_age
+        self.saml_metadata_hash = hashlib.sha256(saml_metadata_text.encode('utf-8')).hexdigest()
+        (self.saml_metadata_valid, self.saml_metadata_valid_until,
+         self.idp_signing_key_fingerprints) = self._inspect_saml_metadata(saml_metadata_text)
+
+        self.saml_client_build_count = 0
+        self.saml_client_build_duration = 0.0
+        self.saml_client_last_build_duration = None
+
+        self._callback_latencies = collections.deque(maxlen=latency_window_size)
+
+    @staticmethod
+    def _parse_valid_until(element):
+        value = element.get('validUntil')
+
+        if not value:
+            return None
+
+        try:
+            return calendar.timegm(saml2.time_util.str_to_time(value))
+        except Exception:
+            LOG.warning('Invalid validUntil "%s" in SAML metadata.', value)
+            return None
+
+    @classmethod
+    def _find_idp_descriptors(cls, element, valid_until=None, idp_descriptors=None):
+        # Collect the IDPSSODescriptor elements along with the earliest validUntil on the path
+        # from the root, which may be nested in EntitiesDescriptor aggregates.
+        if idp_descriptors is None:
+            idp_descriptors = []
+
+        element_valid_until = cls._parse_valid_until(element)
+
+        if element_valid_until is not None:
+            valid_until = min(v for v in [valid_until, element_valid_until] if v is not None)
+
+        if element.tag == '{%s}IDPSSODescriptor' % SAML_METADATA_NS:
+            idp_descriptors.append((element, valid_until))
+            return idp_descriptors
+
+        for child in element:
+            if child.tag in ['{%s}EntitiesDescriptor' % SAML_METADATA_NS,
+                             '{%s}EntityDescriptor' % SAML_METADATA_NS,
+                             '{%s}IDPSSODescriptor' % SAML_METADATA_NS]:
+                cls._find_idp_descriptors(child, valid_until, idp_descriptors)
+
+        return idp_descriptors
+
+    @classmethod
+    def _inspect_saml_metadata(cls, metadata_text):
+        # Return whether the metadata describes an IdP, along with its validUntil and the
+        # fingerprints of its signing keys.
+        valid_until = None
+        fingerprints = []
+
+        try:
+            root = ElementTree.fromstring(metadata_text.encode('utf-8'))
+        except Exception:
+            LOG.warning('Unable to parse the SAML metadata for the health report.', exc_info=True)
+            return False, valid_until, fingerprints
+
+        idp_descriptors = cls._find_idp_descriptors(root)
+
+        if not idp_descriptors:
+            LOG.warning('No IDPSSODescriptor found in the SAML metadata.')
+
+        for idp_descriptor, idp_valid_until in idp_descriptors:
+            if idp_valid_until is not None:
+                valid_until = min(v for v in [valid_until, idp_valid_until] if v is not None)
+
+            for key_descriptor in idp_descriptor.iter('{%s}KeyDescriptor' % SAML_METADATA_NS):
+                if key_descriptor.get('use', 'signing') != 'signing':
+                    continue
+
+                for cert in key_descriptor.iter('{%s}X509Certificate' % XMLDSIG_NS):
+                    try:
+                        der = base64.b64decode(''.join((cert.text or '').split()))
+                    except Exception:
+                        LOG.warning('Unable to decode a signing certificate in SAML metadata.')
+                        continue
+
+                    fingerprint = hashlib.sha256(der).hexdigest()
+
+                    if fingerprint not in fingerprints:
+                        fingerprints.append(fingerprint)
+
+        return bool(idp_descriptors), valid_until, fingerprints
+
     def _get_relay_state_id(self):
         return self.relay_state_id
 
     def _get_saml_client(self):
+        build_start = time.time()
+
         saml_config = saml2.config.Config()
         saml_config.load(self.saml_client_settings)
         saml_config.allow_unknown_attributes = True
+        saml_client = saml2.client.Saml2Client(config=saml_config)
+
+        self.saml_client_last_build_duration = time.time() - build_start
+        self.saml_client_build_duration += self.saml_client_last_build_duration
+        self.saml_client_build_count += 1
+
+        return saml_client
+
+    def _get_sp_metadata_config_hash(self):
+        # The inline IdP metadata is not part of the SP metadata and can be large, so it is
+        # left out of the hash.
+        settings = dict(self.saml_client_settings)
+        settings.pop('metadata', None)
+        settings['sign_metadata'] = self.sign_metadata
+
+        return hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _get_sp_metadata_fingerprint(self):
+        # The fingerprint covers the SP configuration, which is hashed once on init, and the
+        # state of the key and cert files so the metadata is regenerated when the keys change.
+        fingerprint = hashlib.sha256(self._sp_metadata_config_hash.encode('utf-8'))
+
+        for path in [self.saml_client_settings.get('key_file'),
+                     self.saml_client_settings.get('cert_file')]:
+            if path and os.path.isfile(path):
+                stat = os.stat(path)
+                file_state = '%s:%s:%s' % (path, stat.st_mtime, stat.st_size)
+                fingerprint.update(file_state.encode('utf-8'))
+
+        return fingerprint.hexdigest()
+
+    def _build_sp_metadata(self):
+        saml_config = saml2.config.SPConfig()
+        saml_config.load(dict(self.saml_client_settings), metadata_construction=True)
+
+        entity_descriptor = saml2.metadata.entity_descriptor(saml_config)
+        xml_doc = None
+
+        if self.sign_metadata:
+            security_context = saml2.sigver.security_context(saml_config)
+            entity_descriptor, xml_doc = saml2.metadata.sign_entity_descriptor(
+                entity_descriptor,
+                None,
+                security_context
+            )
+
+            # The signed document is returned as text but metadata_tostring_fix expects bytes.
+            xml_doc = six.ensure_binary(xml_doc)
+
+        metadata = saml2.metadata.metadata_tostring_fix(
+            entity_descriptor,
+            SP_METADATA_NSPAIR,
+            xml_doc
+        )
+
+        if isinstance(metadata, six.text_type):
+            metadata = metadata.encode('utf-8')
 
-        return saml2.client.Saml2Client(config=saml_config)
+        return metadata
+
+    def get_sp_metadata(self, if_none_match=None):
+        """
+        Return the SP metadata document for this backend.
+
+        The metadata is generated (and signed if enabled) only when the configuration or
+        the keys change. Otherwise, the cached document is returned.
+
+        :param if_none_match: Value of the If-None-Match header of the request, if any.
+        :type if_none_match: ``str``
+
+        :rtype: ``tuple`` of (status code, ETag, metadata bytes or None if not modified)
+        """
+        fingerprint = self._get_sp_metadata_fingerprint()
+
+        if not self._sp_metadata_cache or self._sp_metadata_cache[0] != fingerprint:
+            LOG.debug('Generating SP metadata for "%s".', self.entity_id)
+            metadata = self._build_sp_metadata()
+            etag = '"%s"' % hashlib.sha256(metadata).hexdigest()
+            self._sp_metadata_cache = (fingerprint, etag, metadata)
+
+        _, etag, metadata = self._sp_metadata_cache
+
+        if if_none_match:
+            tags = [t.strip() for t in if_none_match.split(',')]
+            tags = [t[2:] if t.startswith('W/') else t for t in tags]
+
+            if '*' in tags or etag in tags:
+                return http_client.NOT_MODIFIED, etag, None
+
+        return http_client.OK, etag, metadata
 
     def _handle_verification_error(self, error_message):
         raise auth_exc.SSOVerificationError(error_message)
 
+    def _get_authn_request_template(self):
+        key = (self.entity_id, self.saml_client_settings['metadata']['inline'])
+
+        if self._authn_request_template and self._authn_request_template[0] == key:
+            return self._authn_request_template[1:]
+
+        LOG.debug('Building AuthnRequest template for "%s".', self.entity_id)
+
+        saml_client = self._get_saml_client()
+        destination = saml_client.sso_location(binding=saml2.BINDING_HTTP_REDIRECT)
+        _, authn_request = saml_client.create_authn_request(destination)
+
+        # Only the ID and IssueInstant of the AuthnRequest vary between requests. Replace
+        # them in the serialized request with placeholders to be filled in per request.
+        template = str(authn_request).replace('%', '%%')
+        template = AUTHN_REQUEST_ID_REGEX.sub(' ID="%(id)s"', template, count=1)
+        template = AUTHN_REQUEST_ISSUE_INSTANT_REGEX.sub(
+            ' IssueInstant="%(issue_instant)s"', template, count=1)
+
+        glue_char = '&' if urlparse.urlparse(destination).query else '?'
+        self._authn_request_template = (key, template, destination + glue_char)
+
+        return self._authn_request_template[1:]
+
     def get_request_redirect_url(self, referer):
         if not referer.startswith(self.entity_id):
             self._handle_verification_error('Invalid referer.')
@@ -103,15 +488,99 @@ class SAML2SingleSignOnBackend(st2auth_sso.BaseSingleSignOnBackend):
             'referer': referer
         }
 
-        saml_client = self._get_saml_client()
-        reqid, info = saml_client.prepare_for_authenticate(relay_state=json.dumps(relay_state))
+        # Fill in the prebuilt AuthnRequest and encode it for the HTTP-Redirect binding the
+        # same way as pysaml2 does in prepare_for_authenticate.
+        template, url_prefix = self._get_authn_request_template()
+
+        authn_request = template % {
+            'id': saml2.s_utils.sid(),
+            'issue_instant': saml2.time_util.instant()
+        }
+
+        query = urlparse.urlencode([
+            ('SAMLRequest', saml2.s_utils.deflate_and_base64_encode(authn_request)),
+            ('RelayState', json.dumps(relay_state))
+        ])
+
+        return url_prefix + query
+
+    def dump_captured_responses(self):
+        """
+        Return the redacted SAMLResponse payloads captured for diagnostics.
+
+        :rtype: ``list`` of ``dict``
+        """
+        return self.response_capture.dump()
+
+    def _get_callback_latency_percentiles(self):
+        latencies = sorted(self._callback_latencies)
+        percentiles = {}
+
+        for percentile in CALLBACK_LATENCY_PERCENTILES:
+            key = 'p%s' % percentile
+
+            if not latencies:
+                percentiles[key] = None
+                continue
+
+            # Nearest-rank percentile.
+            rank = max(int(-(-percentile * len(latencies) // 100)), 1)
+            percentiles[key] = latencies[rank - 1]
+
+        return percentiles
+
+    def get_health(self):
+        """
+        Return the readiness and cache state of this backend.
 
-        # Get the IdP URL to send the SAML request to.
-        redirect_url = [v for k, v in six.iteritems(dict(info['headers'])) if k == 'Location'][0]
+        This only reads state recorded at startup and on the request path. It does not fetch
+        metadata or do any crypto, so it is cheap enough to back a health check endpoint.
 
-        return redirect_url
+        :rtype: ``dict``
+        """
+        now = time.time()
+        metadata_age = now - self.saml_metadata_fetched_at
+
+        stale = (self.saml_metadata_valid_until is not None and
+                 self.saml_metadata_valid_until <= now)
+
+        # The metadata is only fetched on startup so its age is the process uptime. It is
+        # reported for information and doesn't affect readiness, otherwise every node started
+        # at the same time would drop out of the load balancer at once.
+        max_age_exceeded = (self.metadata_max_age is not None and
+                            metadata_age > self.metadata_max_age)
+
+        latency = self._get_callback_latency_percentiles()
+        latency['count'] = len(self._callback_latencies)
+
+        return {
+            'ready': self.saml_metadata_ok and self.saml_metadata_valid and not stale,
+            'metadata': {
+                'url': self.saml_metadata_url,
+                'status_code': self.saml_metadata_status_code,
+                'ok': self.saml_metadata_ok,
+                'valid': self.saml_metadata_valid,
+                'fetched_at': self.saml_metadata_fetched_at,
+                'fetch_duration': self.saml_metadata_fetch_duration,
+                'age': metadata_age,
+                'max_age_exceeded': max_age_exceeded,
+                'hash': self.saml_metadata_hash,
+                'valid_until': self.saml_metadata_valid_until,
+                'stale': stale
+            },
+            'signing_key_fingerprints': list(self.idp_signing_key_fingerprints),
+            'saml_client': {
+                'build_count': self.saml_client_build_count,
+                'build_duration': self.saml_client_build_duration,
+                'last_build_duration': self.saml_client_last_build_duration
+            },
+            'callback_latency': latency
+        }
 
     def verify_response(self, response):
+        callback_start = time.time()
+        saml_response = None
+
         try:
             if not hasattr(response, 'SAMLResponse'):
                 self._handle_verification_error('The SAMLResponse attribute is missing.')
@@ -123,6 +592,8 @@ class SAML2SingleSignOnBackend(st2auth_sso.BaseSingleSignOnBackend):
             if len(getattr(response, 'SAMLResponse')) <= 0:
                 self._handle_verification_error('The SAMLResponse attribute is empty.')
 
+            saml_response = getattr(response, 'SAMLResponse')[0]
+
             # The relay state is set by the Sp -> Idp -> Sp flow. If the flow is started by the Idp,
             # the relay state is not set. Verify that the unique value passed as relay state during
             # the request step is the same given back here. The referer address should also be
@@ -146,7 +617,6 @@ class SAML2SingleSignOnBackend(st2auth_sso.BaseSingleSignOnBackend):
                 self._handle_verification_error(error_message)
 
             # Parse the response and verify signature.
-            saml_response = getattr(response, 'SAMLResponse')[0]
             saml_client = self._get_saml_client()
 
             authn_response = saml_client.parse_authn_request_response(
@@ -164,9 +634,14 @@ class SAML2SingleSignOnBackend(st2auth_sso.BaseSingleSignOnBackend):
                 'last_name': str(authn_response.ava['LastName'][0]),
                 'first_name': str(authn_response.ava['FirstName'][0])
             }
-        except Exception:
+        except Exception as e:
             message = 'Error encountered while verifying the SAML2 response.'
             LOG.exception(message)
+            self.response_capture.capture_failure(saml_response, error=str(e))
+            self._callback_latencies.append(time.time() - callback_start)
             raise auth_exc.SSOVerificationError(message)
 
+        self.response_capture.capture_success(saml_response)
+        self._callback_latencies.append(time.time() - callback_start)
+
         return verified_user
@@ -0,0 +1,87 @@
+# Copyright (C) 2020 Extreme Networks, Inc - All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmark SP-initiated redirect generation against pysaml2 prepare_for_authenticate.
+
+Run with st2 components on the PYTHONPATH (see "make benchmarks"):
+
+    python -m tests.benchmarks.benchmark_redirect [--iterations N] [--min-speedup X]
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import argparse
+import json
+import mock
+import six
+import sys
+import timeit
+
+from st2auth_sso_saml2 import saml
+from tests.unit.test_saml import MOCK_ENTITY_ID
+from tests.unit.test_saml import MOCK_METADATA_URL
+from tests.unit.test_saml import MOCK_REFERER
+from tests.unit.test_saml import MockSamlMetadata
+
+
+def get_backend():
+    with mock.patch('requests.get') as mock_requests_get:
+        mock_requests_get.return_value = MockSamlMetadata()
+        return saml.SAML2SingleSignOnBackend(MOCK_ENTITY_ID, MOCK_METADATA_URL)
+
+
+def get_redirect_url_with_pysaml2(backend, referer):
+    # This is how get_request_redirect_url generated the redirect before the
+    # AuthnRequest template was introduced.
+    relay_state = {'id': backend.relay_state_id, 'referer': referer}
+    saml_client = backend._get_saml_client()
+    _, info = saml_client.prepare_for_authenticate(relay_state=json.dumps(relay_state))
+
+    return [v for k, v in six.iteritems(dict(info['headers'])) if k == 'Location'][0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=1000)
+    parser.add_argument('--min-speedup', type=float, default=10.0)
+    args = parser.parse_args()
+
+    backend = get_backend()
+
+    # Build the AuthnRequest template outside of the timed loop.
+    backend.get_request_redirect_url(MOCK_REFERER)
+
+    baseline = timeit.timeit(
+        lambda: get_redirect_url_with_pysaml2(backend, MOCK_REFERER),
+        number=args.iterations
+    )
+
+    template = timeit.timeit(
+        lambda: backend.get_request_redirect_url(MOCK_REFERER),
+        number=args.iterations
+    )
+
+    speedup = baseline / template
+
+    print('pysaml2 prepare_for_authenticate: %.0f redirects/s' % (args.iterations / baseline))
+    print('AuthnRequest template: %.0f redirects/s' % (args.iterations / template))
+    print('Speedup: %.1fx (minimum %.1fx)' % (speedup, args.min_speedup))
+
+    return 0 if speedup >= args.min_speedup else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,12 +14,19 @@
 
 from __future__ import absolute_import
 
+import base64
+import hashlib
 import json
 import mock
+import os
 import saml2
+import shutil
+import tempfile
+import zlib
 
 from oslo_config import cfg
 from six.moves import http_client
+from six.moves.urllib import parse as urlparse
 
 import st2auth
 
@@ -55,18 +62,29 @@ MOCK_SAML_METADATA_TEXT = (
     'or>'
 )
 
-MOCK_REDIRECT_INFO = {
-    'headers': {
-        'Location': MOCK_REDIRECT_URL
-    }
-}
-
 MOCK_USER_USERNAME = 'stanley'
 MOCK_USER_EMAIL = 'stanley@stackstorm.com'
 MOCK_USER_LASTNAME = 'Stormin'
 MOCK_USER_FIRSTNAME = 'Stanley'
 
 
+MOCK_SESSION_INDEX = '_be9967abd904ddcae3c0eb4189adbe3f71e327cf93'
+MOCK_CLIENT_ADDRESS = '10.1.2.3'
+
+MOCK_SAML_RESPONSE_XML = (
+    '<samlp:Response><saml:Assertion><saml:Subject><saml:NameID>%s</saml:NameID></saml:Subject>'
+    '<saml:AttributeStatement><saml:Attribute Name="Email"><saml:AttributeValue>%s</saml:Attrib'
+    'uteValue></saml:Attribute></saml:AttributeStatement></saml:Assertion></samlp:Response>'
+) % (MOCK_USER_USERNAME, MOCK_USER_EMAIL)
+
+MOCK_SAML_RESPONSE_ATTRIBUTES_XML = (
+    '<samlp:Response><saml:Assertion><saml:Subject><saml:NameID NameQualifier="%s" SPNameQualifie'
+    'r="%s">***</saml:NameID><saml:SubjectConfirmation><saml:SubjectConfirmationData Address="%s"'
+    ' /></saml:SubjectConfirmation></saml:Subject><saml:AuthnStatement SessionIndex=\'%s\' /></saml'
+    ':Assertion></samlp:Response>'
+) % (MOCK_IDP_URL, MOCK_ENTITY_ID, MOCK_CLIENT_ADDRESS, MOCK_SESSION_INDEX)
+
+
 class MockSamlMetadata(object):
 
     def __init__(self, text='foobar'):
@@ -76,6 +94,8 @@ class MockSamlMetadata(object):
             MOCK_REDIRECT_URL,
             MOCK_REDIRECT_URL
         )
+        self.status_code = http_client.OK
+        self.ok = True
 
 
 class MockAuthnResponse(object):
@@ -156,15 +176,162 @@ class TestSingleSignOnControllerWithSAML2(BaseSAML2Controller):
         self.assertTrue(saml.SAML2SingleSignOnBackend._handle_verification_error.called)
         saml.SAML2SingleSignOnBackend._handle_verification_error.assert_called_with(expected_msg)
 
-    @mock.patch.object(
-        saml2.client.Saml2Client,
-        'prepare_for_authenticate',
-        mock.MagicMock(return_value=(None, MOCK_REDIRECT_INFO)))
     def test_idp_redirect(self):
         headers = {'referer': MOCK_ENTITY_ID}
         response = self.app.get(SSO_REQUEST_V1_PATH, headers=headers, expect_errors=False)
         self.assertTrue(response.status_code, http_client.TEMPORARY_REDIRECT)
-        self.assertEqual(response.location, MOCK_REDIRECT_URL)
+        self.assertTrue(response.location.startswith(MOCK_REDIRECT_URL + '?SAMLRequest='))
+
+        query = urlparse.parse_qs(urlparse.urlparse(response.location).query)
+        authn_request = zlib.decompress(base64.b64decode(query['SAMLRequest'][0]), -15)
+        self.assertIn(('Destination="%s"' % MOCK_REDIRECT_URL).encode('utf-8'), authn_request)
+        self.assertIn(('AssertionConsumerServiceURL="%s"' % MOCK_ACS_URL).encode('utf-8'),
+                      authn_request)
+
+        relay_state = json.loads(query['RelayState'][0])
+        self.assertEqual(relay_state['referer'], MOCK_ENTITY_ID)
+
+    @mock.patch('saml2.entity.sid', mock.MagicMock(return_value='id-1234567890'))
+    @mock.patch('saml2.s_utils.sid', mock.MagicMock(return_value='id-1234567890'))
+    @mock.patch('saml2.entity.instant', mock.MagicMock(return_value='2020-01-01T00:00:00Z'))
+    @mock.patch('saml2.time_util.instant', mock.MagicMock(return_value='2020-01-01T00:00:00Z'))
+    def test_idp_redirect_matches_pysaml2(self):
+        # Delay import here otherwise setupClass will not have run.
+        from st2auth.controllers.v1 import sso as sso_api_controller
+        instance = sso_api_controller.SSO_BACKEND
+
+        relay_state = {'id': instance.relay_state_id, 'referer': MOCK_REFERER}
+        saml_client = instance._get_saml_client()
+        _, info = saml_client.prepare_for_authenticate(relay_state=json.dumps(relay_state))
+        expected_redirect_url = dict(info['headers'])['Location']
+
+        self.assertEqual(instance.get_request_redirect_url(MOCK_REFERER), expected_redirect_url)
+
+
+class TestSAML2ServiceProviderMetadata(BaseSAML2Controller):
+
+    def setUp(self):
+        super(TestSAML2ServiceProviderMetadata, self).setUp()
+
+        # Delay import here otherwise setupClass will not have run.
+        from st2auth.controllers.v1 import sso as sso_api_controller
+        self.instance = sso_api_controller.SSO_BACKEND
+        self.instance._sp_metadata_cache = None
+
+    def test_get_sp_metadata(self):
+        status, etag, metadata = self.instance.get_sp_metadata()
+        self.assertEqual(status, http_client.OK)
+        self.assertIsNotNone(etag)
+        self.assertIn(('entityID="%s"' % MOCK_ENTITY_ID).encode('utf-8'), metadata)
+        self.assertIn(('Location="%s"' % MOCK_ACS_URL).encode('utf-8'), metadata)
+
+    def test_get_sp_metadata_not_modified(self):
+        _, etag, _ = self.instance.get_sp_metadata()
+
+        status, etag_not_modified, metadata = self.instance.get_sp_metadata(if_none_match=etag)
+        self.assertEqual(status, http_client.NOT_MODIFIED)
+        self.assertEqual(etag_not_modified, etag)
+        self.assertIsNone(metadata)
+
+        status, _, _ = self.instance.get_sp_metadata(if_none_match='W/%s' % etag)
+        self.assertEqual(status, http_client.NOT_MODIFIED)
+
+        status, _, metadata = self.instance.get_sp_metadata(if_none_match='"foobar"')
+        self.assertEqual(status, http_client.OK)
+        self.assertIsNotNone(metadata)
+
+    def test_get_sp_metadata_cached(self):
+        with mock.patch.object(
+                saml.SAML2SingleSignOnBackend,
+                '_build_sp_metadata',
+                mock.MagicMock(return_value=b'<md/>')):
+            self.instance.get_sp_metadata()
+            self.instance.get_sp_metadata()
+            self.assertEqual(saml.SAML2SingleSignOnBackend._build_sp_metadata.call_count, 1)
+
+    def test_get_sp_metadata_keys_changed(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        key_file = os.path.join(temp_dir, 'sp.key')
+        cert_file = os.path.join(temp_dir, 'sp.crt')
+
+        for path in [key_file, cert_file]:
+            with open(path, 'w') as fp:
+                fp.write('-----BEGIN-----\n%s\n-----END-----\n' % MOCK_X509_CERT)
+
+        settings = {'key_file': key_file, 'cert_file': cert_file}
+
+        with mock.patch.dict(self.instance.saml_client_settings, settings):
+            with mock.patch.object(
+                    saml.SAML2SingleSignOnBackend,
+                    '_build_sp_metadata',
+                    mock.MagicMock(return_value=b'<md/>')):
+                self.instance.get_sp_metadata()
+                self.instance.get_sp_metadata()
+                self.assertEqual(saml.SAML2SingleSignOnBackend._build_sp_metadata.call_count, 1)
+
+                stat = os.stat(cert_file)
+                os.utime(cert_file, (stat.st_atime, stat.st_mtime + 60))
+
+                self.instance.get_sp_metadata()
+                self.assertEqual(saml.SAML2SingleSignOnBackend._build_sp_metadata.call_count, 2)
+
+    @mock.patch('saml2.sigver.security_context', mock.MagicMock())
+    @mock.patch('saml2.metadata.sign_entity_descriptor')
+    def test_get_sp_metadata_signed(self, mock_sign_entity_descriptor):
+        signed_xml = '<ns0:EntityDescriptor signed="true" />'
+        mock_sign_entity_descriptor.side_effect = lambda ed, ident, secc: (ed, signed_xml)
+
+        with mock.patch.object(self.instance, 'sign_metadata', True):
+            status, _, metadata = self.instance.get_sp_metadata()
+
+        self.assertEqual(status, http_client.OK)
+        self.assertTrue(mock_sign_entity_descriptor.called)
+        self.assertTrue(saml2.sigver.security_context.called)
+        self.assertIn(b'signed="true"', metadata)
+
+    def test_sign_metadata_requires_keys(self):
+        with mock.patch('requests.get') as mock_requests_get:
+            mock_requests_get.return_value = MockSamlMetadata()
+
+            self.assertRaises(
+                ValueError,
+                saml.SAML2SingleSignOnBackend,
+                MOCK_ENTITY_ID,
+                MOCK_METADATA_URL,
+                sign_metadata=True
+            )
+
+            self.assertRaises(
+                ValueError,
+                saml.SAML2SingleSignOnBackend,
+                MOCK_ENTITY_ID,
+                MOCK_METADATA_URL,
+                key_file='/tmp/sp.key',
+                sign_metadata=True
+            )
+
+    def test_get_sp_metadata_config_changed(self):
+        _, etag, _ = self.instance.get_sp_metadata()
+
+        with mock.patch.dict(self.instance.saml_client_settings, {'entityid': MOCK_IDP_URL}):
+            config_hash = self.instance._get_sp_metadata_config_hash()
+
+            with mock.patch.object(self.instance, '_sp_metadata_config_hash', config_hash):
+                status, new_etag, metadata = self.instance.get_sp_metadata(if_none_match=etag)
+
+            self.assertEqual(status, http_client.OK)
+            self.assertNotEqual(new_etag, etag)
+            self.assertIn(('entityID="%s"' % MOCK_IDP_URL).encode('utf-8'), metadata)
+
+    def test_get_sp_metadata_ignores_idp_metadata(self):
+        _, etag, _ = self.instance.get_sp_metadata()
+
+        with mock.patch.dict(self.instance.saml_client_settings, {'metadata': {'inline': []}}):
+            self.assertEqual(self.instance._get_sp_metadata_config_hash(),
+                             self.instance._sp_metadata_config_hash)
+            status, _, _ = self.instance.get_sp_metadata(if_none_match=etag)
+            self.assertEqual(status, http_client.NOT_MODIFIED)
 
 
 class TestIdentityProviderCallbackController(BaseSAML2Controller):
@@ -332,3 +499,260 @@ class TestIdentityProviderCallbackController(BaseSAML2Controller):
         response = self.app.post_json(SSO_CALLBACK_V1_PATH, saml_response, expect_errors=False)
         self.assertTrue(response.status_code, http_client.OK)
         self.assertEqual(expected_body, response.body.decode('utf-8'))
+
+
+class TestSAMLResponseCapture(BaseSAML2Controller):
+
+    def setUp(self):
+        super(TestSAMLResponseCapture, self).setUp()
+
+        # Delay import here otherwise setupClass will not have run.
+        from st2auth.controllers.v1 import sso as sso_api_controller
+        self.instance = sso_api_controller.SSO_BACKEND
+        self.instance.response_capture.clear()
+
+    def test_capture_redacted(self):
+        capture = saml.SAMLResponseCapture(size=1)
+        capture.capture_failure(base64.b64encode(MOCK_SAML_RESPONSE_XML.encode('utf-8')))
+        records = capture.dump()
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['outcome'], 'failure')
+        self.assertFalse(records[0]['truncated'])
+        self.assertIn('<saml:NameID>***</saml:NameID>', records[0]['payload'])
+        self.assertIn('<saml:AttributeValue>***</saml:AttributeValue>', records[0]['payload'])
+        self.assertNotIn(MOCK_USER_USERNAME, records[0]['payload'])
+        self.assertNotIn(MOCK_USER_EMAIL, records[0]['payload'])
+
+        capture.capture_failure(
+            base64.b64encode(MOCK_SAML_RESPONSE_ATTRIBUTES_XML.encode('utf-8')))
+        records = capture.dump()
+        self.assertEqual(len(records), 1)
+        self.assertIn('NameQualifier="***"', records[0]['payload'])
+        self.assertIn('SPNameQualifier="***"', records[0]['payload'])
+        self.assertIn('Address="***"', records[0]['payload'])
+        self.assertIn('SessionIndex="***"', records[0]['payload'])
+
+        for value in [MOCK_IDP_URL, MOCK_ENTITY_ID, MOCK_CLIENT_ADDRESS, MOCK_SESSION_INDEX]:
+            self.assertNotIn(value, records[0]['payload'])
+
+    def test_capture_redacted_bom(self):
+        capture = saml.SAMLResponseCapture(size=1)
+        payload = b'\xef\xbb\xbf' + MOCK_SAML_RESPONSE_XML.encode('utf-8')
+        capture.capture_failure(base64.b64encode(payload).decode('ascii'))
+        records = capture.dump()
+        self.assertIn('<saml:NameID>***</saml:NameID>', records[0]['payload'])
+        self.assertNotIn(MOCK_USER_USERNAME, records[0]['payload'])
+        self.assertNotIn(MOCK_USER_EMAIL, records[0]['payload'])
+
+    def test_capture_redacted_non_utf8(self):
+        capture = saml.SAMLResponseCapture(size=1)
+        xml = '<?xml version="1.0" encoding="ISO-8859-1"?>' + MOCK_SAML_RESPONSE_XML
+        xml = xml.replace(MOCK_USER_LASTNAME, u'St\xf6rmin')
+        capture.capture_failure(base64.b64encode(xml.encode('iso-8859-1')))
+        records = capture.dump()
+        self.assertIn('<saml:NameID>***</saml:NameID>', records[0]['payload'])
+        self.assertNotIn(MOCK_USER_USERNAME, records[0]['payload'])
+        self.assertNotIn(MOCK_USER_EMAIL, records[0]['payload'])
+
+    def test_capture_redacted_cut_off(self):
+        capture = saml.SAMLResponseCapture(size=1)
+        xml = MOCK_SAML_RESPONSE_XML[:MOCK_SAML_RESPONSE_XML.index(MOCK_USER_USERNAME) + 3]
+        capture.capture_failure(base64.b64encode(xml.encode('utf-8')))
+        records = capture.dump()
+        self.assertTrue(records[0]['payload'].endswith('<saml:NameID>***'))
+        self.assertNotIn(MOCK_USER_USERNAME[:3], records[0]['payload'])
+
+    def test_capture_not_redactable(self):
+        capture = saml.SAMLResponseCapture(size=2)
+        payload = base64.b64encode(b'\xff\xfe' + MOCK_SAML_RESPONSE_XML.encode('utf-16-le'))
+        capture.capture_failure(payload)
+        capture.capture_failure('1234567890ABCDEFG')
+        records = capture.dump()
+        self.assertListEqual([r['payload'] for r in records], [None, None])
+        self.assertEqual(records[0]['payload_length'], len(payload))
+        self.assertEqual(records[0]['payload_sha256'], hashlib.sha256(payload).hexdigest())
+        self.assertEqual(records[1]['payload_length'], 17)
+
+    def test_capture_bounded(self):
+        capture = saml.SAMLResponseCapture(size=2, max_payload_size=4)
+        for payload in ['<foo/>', '<bar/>', '<a/>']:
+            capture.capture_failure(payload)
+        records = capture.dump()
+        self.assertListEqual([r['payload'] for r in records], ['<bar', '<a/>'])
+        self.assertListEqual([r['truncated'] for r in records], [True, False])
+
+    def test_capture_disabled(self):
+        capture = saml.SAMLResponseCapture(size=0, sample_rate=1.0)
+        capture.capture_failure('foobar')
+        capture.capture_success('foobar')
+        self.assertListEqual(capture.dump(), [])
+
+    @mock.patch.object(
+        saml2.client.Saml2Client,
+        'parse_authn_request_response',
+        mock.MagicMock(side_effect=Exception('Signature verification failed.')))
+    def test_idp_callback_failure_captured(self):
+        saml_response = {'SAMLResponse': ['1234567890ABCDEFG']}
+        response = self.app.post_json(SSO_CALLBACK_V1_PATH, saml_response, expect_errors=True)
+        self.assertTrue(response.status_code, http_client.UNAUTHORIZED)
+        records = self.instance.dump_captured_responses()
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['outcome'], 'failure')
+        self.assertEqual(records[0]['error'], 'Signature verification failed.')
+        self.assertIsNone(records[0]['payload'])
+        self.assertEqual(records[0]['payload_length'], len('1234567890ABCDEFG'))
+
+    @mock.patch.object(
+        saml2.client.Saml2Client,
+        'parse_authn_request_response',
+        mock.MagicMock(return_value=MockAuthnResponse()))
+    def test_idp_callback_success_not_sampled(self):
+        saml_response = {'SAMLResponse': ['1234567890ABCDEFG']}
+        response = self.app.post_json(SSO_CALLBACK_V1_PATH, saml_response, expect_errors=False)
+        self.assertTrue(response.status_code, http_client.OK)
+        self.assertListEqual(self.instance.dump_captured_responses(), [])
+
+    @mock.patch.object(
+        saml2.client.Saml2Client,
+        'parse_authn_request_response',
+        mock.MagicMock(return_value=MockAuthnResponse()))
+    def test_idp_callback_success_sampled(self):
+        saml_response = {'SAMLResponse': ['1234567890ABCDEFG']}
+
+        with mock.patch.object(self.instance.response_capture, 'sample_rate', 1.0):
+            response = self.app.post_json(SSO_CALLBACK_V1_PATH, saml_response)
+
+        self.assertTrue(response.status_code, http_client.OK)
+        records = self.instance.dump_captured_responses()
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['outcome'], 'success')
+
+
+class TestSAML2BackendHealth(BaseSAML2Controller):
+
+    def setUp(self):
+        super(TestSAML2BackendHealth, self).setUp()
+
+        # Delay import here otherwise setupClass will not have run.
+        from st2auth.controllers.v1 import sso as sso_api_controller
+        self.instance = sso_api_controller.SSO_BACKEND
+        self.instance._callback_latencies.clear()
+
+    def test_get_health(self):
+        health = self.instance.get_health()
+        self.assertTrue(health['ready'])
+        self.assertEqual(health['metadata']['url'], MOCK_METADATA_URL)
+        self.assertEqual(
+            health['metadata']['hash'],
+            hashlib.sha256(MockSamlMetadata().text.encode('utf-8')).hexdigest()
+        )
+        self.assertIsNone(health['metadata']['valid_until'])
+        self.assertFalse(health['metadata']['stale'])
+        self.assertIsNotNone(health['metadata']['fetched_at'])
+        self.assertIn('build_count', health['saml_client'])
+        self.assertDictEqual(
+            health['callback_latency'],
+            {'count': 0, 'p50': None, 'p90': None, 'p99': None}
+        )
+
+        # The health report must be serializable for the health endpoint.
+        json.dumps(health)
+
+    def test_get_health_metadata_max_age(self):
+        self.assertFalse(self.instance.get_health()['metadata']['max_age_exceeded'])
+
+        with mock.patch.object(self.instance, 'metadata_max_age', 0):
+            health = self.instance.get_health()
+            self.assertTrue(health['ready'])
+            self.assertTrue(health['metadata']['max_age_exceeded'])
+            self.assertFalse(health['metadata']['stale'])
+
+    def test_get_health_metadata_fetch_failed(self):
+        self.assertEqual(self.instance.get_health()['metadata']['status_code'], http_client.OK)
+
+        with mock.patch.object(self.instance, 'saml_metadata_ok', False), \
+                mock.patch.object(self.instance, 'saml_metadata_status_code',
+                                  http_client.SERVICE_UNAVAILABLE):
+            health = self.instance.get_health()
+            self.assertFalse(health['ready'])
+            self.assertFalse(health['metadata']['ok'])
+            self.assertEqual(health['metadata']['status_code'], http_client.SERVICE_UNAVAILABLE)
+
+    def test_get_health_metadata_expired(self):
+        with mock.patch.object(self.instance, 'saml_metadata_valid_until', 0):
+            health = self.instance.get_health()
+            self.assertFalse(health['ready'])
+            self.assertTrue(health['metadata']['stale'])
+
+    def test_get_health_metadata_not_saml(self):
+        self.assertTrue(self.instance.get_health()['metadata']['valid'])
+
+        for text in ['<html>IdP login page</html>', 'IdP login page', '']:
+            mock_metadata = MockSamlMetadata()
+            mock_metadata.text = text
+
+            with mock.patch('requests.get') as mock_requests_get:
+                mock_requests_get.return_value = mock_metadata
+                instance = saml.SAML2SingleSignOnBackend(MOCK_ENTITY_ID, MOCK_METADATA_URL)
+
+            health = instance.get_health()
+            self.assertFalse(health['ready'])
+            self.assertFalse(health['metadata']['valid'])
+
+    def test_inspect_saml_metadata(self):
+        cert = base64.b64encode(b'foobar').decode('utf-8')
+        metadata = MockSamlMetadata().text.replace(MOCK_X509_CERT, cert).replace(
+            '<md:EntityDescriptor ', '<md:EntityDescriptor validUntil="2030-01-01T00:00:00Z" ')
+
+        valid, valid_until, fingerprints = self.instance._inspect_saml_metadata(metadata)
+        self.assertTrue(valid)
+        self.assertEqual(valid_until, 1893456000)
+        self.assertListEqual(fingerprints, [hashlib.sha256(b'foobar').hexdigest()])
+
+    def test_inspect_saml_metadata_aggregate(self):
+        cert = base64.b64encode(b'foobar').decode('utf-8')
+        entity = MockSamlMetadata().text.replace(MOCK_X509_CERT, cert).replace(
+            '<md:EntityDescriptor ', '<md:EntityDescriptor validUntil="2025-01-01T00:00:00Z" ')
+        entity = entity[entity.index('<md:EntityDescriptor '):]
+
+        metadata = (
+            '<md:EntitiesDescriptor validUntil="2030-01-01T00:00:00Z" '
+            'xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata">%s</md:EntitiesDescriptor>'
+        ) % entity
+
+        valid, valid_until, fingerprints = self.instance._inspect_saml_metadata(metadata)
+        self.assertTrue(valid)
+        self.assertEqual(valid_until, 1735689600)
+        self.assertListEqual(fingerprints, [hashlib.sha256(b'foobar').hexdigest()])
+
+    def test_inspect_saml_metadata_entity_expansion(self):
+        metadata = (
+            '<?xml version="1.0"?><!DOCTYPE md [<!ENTITY a "aaaaaaaaaa">'
+            '<!ENTITY b "&a;&a;&a;&a;&a;&a;&a;&a;&a;&a;">]>'
+            '<md:EntityDescriptor validUntil="2030-01-01T00:00:00Z" '
+            'xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata">&b;</md:EntityDescriptor>'
+        )
+
+        self.assertEqual(self.instance._inspect_saml_metadata(metadata), (False, None, []))
+
+    def test_get_saml_client_build_count(self):
+        build_count = self.instance.get_health()['saml_client']['build_count']
+        self.instance._get_saml_client()
+        health = self.instance.get_health()
+        self.assertEqual(health['saml_client']['build_count'], build_count + 1)
+        self.assertIsNotNone(health['saml_client']['last_build_duration'])
+
+    @mock.patch.object(
+        saml2.client.Saml2Client,
+        'parse_authn_request_response',
+        mock.MagicMock(return_value=MockAuthnResponse()))
+    def test_idp_callback_latency(self):
+        saml_response = {'SAMLResponse': ['1234567890ABCDEFG']}
+
+        for _ in range(3):
+            self.app.post_json(SSO_CALLBACK_V1_PATH, saml_response, expect_errors=False)
+
+        latency = self.instance.get_health()['callback_latency']
+        self.assertEqual(latency['count'], 3)
+        self.assertLessEqual(latency['p50'], latency['p90'])
+        self.assertLessEqual(latency['p90'], latency['p99'])